@@ -22,6 +22,7 @@ setup(name="pipelinewise-target-vertica",
           'vertica-python==1.0.1',
           'inflection==0.3.1',
           'joblib~=1.0.0',
+          'orjson==3.*',
       ],
       extras_require={
           "test": [
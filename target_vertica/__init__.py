@@ -3,10 +3,9 @@
 import argparse
 import io
 import json
-import os
 import sys
 import copy
-from tempfile import mkstemp
+from datetime import datetime
 
 from joblib import Parallel, delayed, parallel_backend
 from jsonschema import Draft7Validator, FormatChecker
@@ -20,6 +19,7 @@ from target_vertica.exceptions import (
 
 
 from target_vertica.utils import (
+    BytesIteratorReader,
     float_to_decimal,
     add_metadata_columns_to_schema,
     add_metadata_values_to_record,
@@ -33,9 +33,44 @@ DEFAULT_PARALLELISM = 0  # 0 The number of threads used to flush tables
 DEFAULT_MAX_PARALLELISM = 16  # Don't use more than this number of threads by default when flushing streams in parallel
 
 
-# pylint: disable=too-many-locals,too-many-branches,too-many-statements,invalid-name,consider-iterating-dictionary
-def persist_lines(config, lines):
+def get_target_schemas(config):
+    """Collect every target schema name defined in the config"""
+    target_schemas = []
+    if config.get('default_target_schema'):
+        target_schemas.append(config['default_target_schema'].strip())
+
+    schema_mapping = config.get('schema_mapping') or {}
+    for mapping in schema_mapping.values():
+        if mapping.get('target_schema'):
+            target_schemas.append(mapping['target_schema'])
+
+    return list(set(target_schemas))
+
+
+def load_table_cache(config):
+    """Load the columns of every table in the target schemas with one metadata query"""
+    table_cache = None
+    if not config.get('disable_table_cache'):
+        LOGGER.info('Getting catalog objects from vertica metadata...')
+        with DbSync(config) as db_sync:
+            table_cache = db_sync.load_catalog_cache(get_target_schemas(config))
+
+    return table_cache
+
+
+def persist_lines(config, lines, table_cache=None):
     """Read singer messages and process them line by line"""
+    stream_to_sync = {}
+    try:
+        _persist_lines(config, lines, table_cache, stream_to_sync)
+    finally:
+        # close every stream's connection to vertica, even if loading failed
+        for db_sync in stream_to_sync.values():
+            db_sync.close()
+
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements,invalid-name,consider-iterating-dictionary
+def _persist_lines(config, lines, table_cache, stream_to_sync):
     state = None
     flushed_state = None
     schemas = {}
@@ -43,10 +78,13 @@ def persist_lines(config, lines):
     validators = {}
     records_to_load = {}
     row_count = {}
-    stream_to_sync = {}
     total_row_count = {}
     batch_size_rows = config.get('batch_size_rows', DEFAULT_BATCH_SIZE_ROWS)
-    parallelism = config.get("parallelism", -1)
+    # _sdc_batched_at metadata value per stream, set when the first record of a new batch arrives
+    batched_at = {}
+    # Streams with an open session, the least recently flushed first
+    flushed_streams = {}
+    max_sessions = config.get('max_parallelism', DEFAULT_MAX_PARALLELISM)
 
     # Loop over lines from stdin
     for line in lines:
@@ -83,7 +121,17 @@ def persist_lines(config, lines):
                             "or more) Try removing 'multipleOf' methods from JSON schema.")
                     raise RecordValidationException(f"Record does not pass schema validation. RECORD: {o['record']}")
 
-            primary_key_string = stream_to_sync[stream].record_primary_key_string(o['record'])
+            if config.get('add_metadata_columns') or config.get('hard_delete'):
+                if stream not in batched_at:
+                    batched_at[stream] = datetime.now().isoformat()
+                record = add_metadata_values_to_record(o, batched_at[stream])
+            else:
+                record = o['record']
+
+            # Flatten only once, the flattened record is used for the PK and for the CSV line as well
+            flatten = stream_to_sync[stream].flatten(record)
+
+            primary_key_string = stream_to_sync[stream].record_primary_key_string(flatten)
             if not primary_key_string:
                 primary_key_string = 'RID-{}'.format(total_row_count[stream])
 
@@ -96,10 +144,7 @@ def persist_lines(config, lines):
                 total_row_count[stream] += 1
 
             # append record
-            if config.get('add_metadata_columns') or config.get('hard_delete'):
-                records_to_load[stream][primary_key_string] = add_metadata_values_to_record(o)
-            else:
-                records_to_load[stream][primary_key_string] = o['record']
+            records_to_load[stream][primary_key_string] = flatten
 
             row_count[stream] = len(records_to_load[stream])
 
@@ -123,6 +168,13 @@ def persist_lines(config, lines):
                 # emit last encountered state
                 emit_state(copy.deepcopy(flushed_state))
 
+                close_idle_sessions(stream_to_sync, flushed_streams, filter_streams or list(records_to_load),
+                                    max_sessions)
+
+                # the next records of the flushed streams start a new batch
+                for flushed_stream in filter_streams or list(batched_at):
+                    batched_at.pop(flushed_stream, None)
+
         elif t == 'SCHEMA':
             if 'stream' not in o:
                 raise Exception("Line is missing required key 'stream': {}".format(line))
@@ -139,6 +191,10 @@ def persist_lines(config, lines):
                 # emit latest encountered state
                 emit_state(flushed_state)
 
+                close_idle_sessions(stream_to_sync, flushed_streams, list(records_to_load), max_sessions)
+
+                batched_at.clear()
+
             # key_properties key must be available in the SCHEMA message.
             if 'key_properties' not in o:
                 raise Exception("key_properties field is required")
@@ -157,13 +213,19 @@ def persist_lines(config, lines):
 
             key_properties[stream] = o['key_properties']
 
+            # Close the connection of the DbSync instance that we replace with a new one
+            if stream in stream_to_sync:
+                stream_to_sync[stream].close()
+
             if config.get('add_metadata_columns') or config.get('hard_delete'):
-                stream_to_sync[stream] = DbSync(config, add_metadata_columns_to_schema(o))
+                stream_to_sync[stream] = DbSync(config, add_metadata_columns_to_schema(o), table_cache)
             else:
-                stream_to_sync[stream] = DbSync(config, o)
+                stream_to_sync[stream] = DbSync(config, o, table_cache)
 
             stream_to_sync[stream].create_schema_if_not_exists()
             stream_to_sync[stream].sync_table()
+            # Don't keep a session open for every stream, it's reopened when the stream is flushed
+            stream_to_sync[stream].close()
 
             row_count[stream] = 0
             total_row_count[stream] = 0
@@ -197,6 +259,20 @@ def persist_lines(config, lines):
     emit_state(copy.deepcopy(flushed_state))
 
 
+def close_idle_sessions(stream_to_sync, flushed_streams, streams, max_sessions):
+    """Mark streams as the most recently flushed and close the sessions of the least
+    recently flushed streams above max_sessions
+
+    Open sessions keep the temp table of their stream, the next batch truncates and reuses it"""
+    for stream in streams:
+        flushed_streams.pop(stream, None)
+        flushed_streams[stream] = True
+
+    for stream in list(flushed_streams)[:max(len(flushed_streams) - max_sessions, 0)]:
+        stream_to_sync[stream].close()
+        del flushed_streams[stream]
+
+
 # pylint: disable=too-many-arguments
 def flush_streams(
         streams,
@@ -220,24 +296,24 @@ def flush_streams(
     parallelism = config.get("parallelism", DEFAULT_PARALLELISM)
     max_parallelism = config.get("max_parallelism", DEFAULT_MAX_PARALLELISM)
 
+    # Select the required streams to flush
+    if filter_streams:
+        streams_to_flush = filter_streams
+    else:
+        streams_to_flush = streams.keys()
+
     # Parallelism 0 means auto parallelism:
     #
     # Auto parallelism trying to flush streams efficiently with auto defined number
     # of threads where the number of threads is the number of streams that need to
     # be loaded but it's not greater than the value of max_parallelism
     if parallelism == 0:
-        n_streams_to_flush = len(streams.keys())
+        n_streams_to_flush = len(streams_to_flush)
         if n_streams_to_flush > max_parallelism:
             parallelism = max_parallelism
         else:
             parallelism = n_streams_to_flush
 
-    # Select the required streams to flush
-    if filter_streams:
-        streams_to_flush = filter_streams
-    else:
-        streams_to_flush = streams.keys()
-
     # Single-host, thread-based parallelism
     with parallel_backend('threading', n_jobs=parallelism):
         Parallel()(delayed(load_stream_batch)(
@@ -245,8 +321,7 @@ def flush_streams(
             records_to_load=streams[stream],
             row_count=row_count,
             db_sync=stream_to_sync[stream],
-            delete_rows=config.get('hard_delete'),
-            temp_dir=config.get('temp_dir')
+            delete_rows=config.get('hard_delete')
         ) for stream in streams_to_flush)
 
     # reset flushed stream records to empty to avoid flushing same records
@@ -271,13 +346,12 @@ def flush_streams(
     return flushed_state
 
 
-# pylint: disable=too-many-arguments
-def load_stream_batch(stream, records_to_load, row_count, db_sync, delete_rows=False, temp_dir=None):
+def load_stream_batch(stream, records_to_load, row_count, db_sync, delete_rows=False):
     """Load a batch of records and do post load operations, like creating
     or deleting rows"""
     # Load into vertica
     if row_count[stream] > 0:
-        flush_records(stream, records_to_load, row_count[stream], db_sync, temp_dir)
+        flush_records(stream, records_to_load, row_count[stream], db_sync)
     # Load finished, create indices if required
     db_sync.create_projections(stream)
     # Delete soft-deleted, flagged rows - where _sdc_deleted at is not null
@@ -288,24 +362,12 @@ def load_stream_batch(stream, records_to_load, row_count, db_sync, delete_rows=F
 
 
 # pylint: disable=unused-argument
-def flush_records(stream, records_to_load, row_count, db_sync, temp_dir=None):
-    """Take a list of records and load into database"""
-    if temp_dir:
-        temp_dir = os.path.expanduser(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
-
-    size_bytes = 0
-    csv_fd, csv_file = mkstemp(suffix='.csv', prefix=f'{stream}_', dir=temp_dir)
-    with open(csv_fd, 'w+b') as f:
-        for record in records_to_load.values():
-            csv_line = db_sync.record_to_csv_line(record)
-            f.write(bytes(csv_line + '\n', 'UTF-8'))
+def flush_records(stream, records_to_load, row_count, db_sync):
+    """Take a list of records and load into database
 
-    size_bytes = os.path.getsize(csv_file)
-    db_sync.load_csv(csv_file, row_count, size_bytes)
-
-    # Delete temp file
-    os.remove(csv_file)
+    CSV lines are generated while COPY reads the stream, without a temporary CSV file"""
+    csv_lines = (db_sync.record_to_csv_line_bytes(flatten) + b'\n' for flatten in records_to_load.values())
+    db_sync.load_csv_batches([BytesIteratorReader(csv_lines)], row_count)
 
 
 def main():
@@ -320,9 +382,11 @@ def main():
     else:
         config = {}
 
+    table_cache = load_table_cache(config)
+
     # Consume singer messages
     singer_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    persist_lines(config, singer_messages)
+    persist_lines(config, singer_messages, table_cache)
 
     LOGGER.debug("Exiting normally")
 
@@ -1,16 +1,20 @@
+import itertools
 import json
+import math
+import os
 import re
 import sys
 import uuid
 import time
-from singer import get_logger
-import vertica_python as vertica
+import orjson
 
 from target_vertica.utils import (
     column_clause,
     column_type,
+    compile_flatten_record,
     flatten_schema,
     flatten_record,
+    json_dump_columns,
     format_json,
     primary_column_names,
     safe_column_name,
@@ -23,12 +27,51 @@ NUMERIC_DATA_TYPE = "numeric"
 RE_NUMERIC = re.compile(rf'{NUMERIC_DATA_TYPE}', re.I)
 RE_PRECISION = re.compile(rf'{NUMERIC_DATA_TYPE}\([0-9]+(,[0-9]+)?\)', re.I)
 
+# Temp table names are unique per process. The random part is generated only once and keeps
+# rejection tables of processes running on different hosts apart.
+TEMP_TABLE_PREFIX = 'tmp_{}_{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+TEMP_TABLE_SEQUENCE = itertools.count()
+
+# Size of the chunks read from the CSV buffers and sent to COPY FROM STDIN
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def csv_value(value):
+    """Encode a flattened record value to CSV bytes, empty for NULL"""
+    if value == 0 or value:
+        # orjson encodes NaN and Infinity as null, the standard encoder keeps them for FLOAT columns
+        if isinstance(value, float) and not math.isfinite(value):
+            return json.dumps(value).encode('utf-8')
+        try:
+            return orjson.dumps(value)
+        except orjson.JSONEncodeError:
+            # orjson supports 64-bit integers only, fall back to the standard encoder
+            return json.dumps(value, ensure_ascii=False).encode('utf-8')
+    return b''
+
+
+# pylint: disable=exec-used
+def compile_csv_formatter(column_names):
+    """Generate a function that encodes a flattened record to a CSV line
+
+    The generated function has one statement per column, it does not iterate
+    the flatten schema for every record"""
+    source = "def csv_line(flatten):\n    get = flatten.get\n    return b','.join((\n"
+    for name in column_names:
+        source += '        csv_value(get({!r})),\n'.format(name)
+    source += '    ))\n'
+
+    namespace = {}
+    exec(compile(source, '<csv_line>', 'exec'), {'csv_value': csv_value}, namespace)
+    return namespace['csv_line']
+
 
 # pylint: disable=too-many-public-methods,too-many-instance-attributes,missing-class-docstring,missing-function-docstring
 class DbSync:
     """Data sync class for vertica"""
 
-    def __init__(self, connection_config, stream_schema_message=None):
+    # pylint: disable=too-many-statements
+    def __init__(self, connection_config, stream_schema_message=None, table_cache=None):
         """
             connection_config:      Vertica connection details
 
@@ -46,12 +89,22 @@ class DbSync:
                                     Vertica and can run individual queries. For example
                                     collecting catalog information from Vertica for caching
                                     purposes.
+
+            table_cache:            Optional pre-collected columns of every table in the target
+                                    schemas, created by load_catalog_cache. If defined then
+                                    the catalog is not queried for every table.
         """
         self.connection_config = connection_config
         self.stream_schema_message = stream_schema_message
+        self.table_cache = table_cache
+
+        # Connection opened on the first query and reused until close() is called
+        self.connection = None
+        # Temp table of the batches, created once per connection and truncated for every batch
+        self.temp_table = None
 
         # logger to be used across the class's methods
-        self.logger = get_logger('target_vertica')
+        self.logger = LOGGER
 
         # Validate connection configuration
         config_errors = validate_config(connection_config)
@@ -62,7 +115,31 @@ class DbSync:
                               '\n   * '.join(config_errors))
             sys.exit(1)
 
+        # Connection parameters are the same for every connection of the instance
+        self.connection_params = dict(
+            host=self.connection_config['host'],
+            user=self.connection_config['user'],
+            port=self.connection_config['port'],
+            password=self.connection_config['password'],
+            database=self.connection_config['dbname'],
+            # autocommit is off by default
+            autocommit=True,
+            # using server-side prepared statements is disabled by default
+            use_prepared_statements=False,
+            # This will not log from root vertica.
+            log_path=None
+        )
+
+        # SSL is disabled by default
+        if 'ssl' in self.connection_config:
+            ssl = self.connection_config['ssl']
+            # Only explicit false strings turn SSL off, any other string enables it like a truthy value
+            if isinstance(ssl, str):
+                ssl = ssl.strip().lower() not in ('false', '0', '')
+            self.connection_params['ssl'] = ssl
+
         self.schema_name = None
+        self.schema_name_lower = None
         self.grantees = None
 
         # Init stream schema
@@ -96,9 +173,9 @@ class DbSync:
                 'schema_mapping', {})
 
             stream_name = stream_schema_message['stream']
-            stream_schema_name = stream_name_to_dict(stream_name)[
-                'schema_name']
-            stream_table_name = stream_name_to_dict(stream_name)['table_name']
+            stream_dict = stream_name_to_dict(stream_name)
+            stream_schema_name = stream_dict['schema_name']
+            stream_table_name = stream_dict['table_name']
             if config_schema_mapping and stream_schema_name in config_schema_mapping:
                 self.schema_name = config_schema_mapping[stream_schema_name].get(
                     'target_schema')
@@ -118,6 +195,14 @@ class DbSync:
                     "Neither 'default_target_schema' (string) nor 'schema_mapping' (object) defines "
                     "target schema for {} stream.".format(stream_name))
 
+            # Vertica metadata is looked up case insensitively
+            self.schema_name_lower = self.schema_name.lower()
+
+            # Target table names are fixed for the stream, generate them only once
+            v_table_name = stream_table_name.replace('.', '_').replace('-', '_').lower()
+            self.target_table_without_schema = f'"{v_table_name}"'
+            self.target_table = f'{self.schema_name}.{self.target_table_without_schema}'
+
             #  Define grantees
             #  ---------------
             #  Grantees can be defined in multiple ways:
@@ -144,60 +229,124 @@ class DbSync:
                 'data_flattening_max_level', 0)
             self.flatten_schema = flatten_schema(stream_schema_message['schema'],
                                                  max_level=self.data_flattening_max_level)
+            self.json_dump_columns = json_dump_columns(self.flatten_schema)
+            self.csv_formatter = compile_csv_formatter(self.flatten_schema)
+            if self.data_flattening_max_level == 0:
+                # Key properties are always copied, a missing one has to be reported by record_primary_key_string
+                property_names = list(stream_schema_message['schema'].get('properties', {}))
+                property_names += [k for k in stream_schema_message['key_properties'] if k not in property_names]
+                self.record_flattener = compile_flatten_record(property_names, self.json_dump_columns)
+
+            # Column and primary key lists are fixed for the stream, generate SQL fragments only once
+            self.safe_column_names = [safe_column_name(name) for name in self.flatten_schema]
+            self.primary_key_names = primary_column_names(stream_schema_message)
+            self.columns_sql = ', '.join(self.safe_column_names)
+            self.column_clauses_sql = ', '.join(
+                [column_clause(name, schema) for (name, schema) in self.flatten_schema.items()] +
+                (["PRIMARY KEY ({})".format(', '.join(self.primary_key_names))] if self.primary_key_names else []))
+            self.primary_key_conditions = {}
 
     def open_connection(self):
         """Open Vertica connection"""
-        conn_string = dict(
-            host=self.connection_config['host'],
-            user=self.connection_config['user'],
-            port=self.connection_config['port'],
-            password=self.connection_config['password'],
-            database=self.connection_config['dbname'],
-            # autocommit is off by default
-            autocommit=True,
-            # using server-side prepared statements is disabled by default
-            use_prepared_statements=False,
-            # This will not log from root vertica.
-            log_path=None
-        )
+        # vertica_python is imported only when connecting, it's not required to parse the config
+        import vertica_python as vertica  # pylint: disable=import-outside-toplevel
 
-        # SSL is disabled by default
-        if 'ssl' in self.connection_config:
-            conn_string['ssl'] = self.connection_config['ssl']
+        return vertica.connect(**self.connection_params)
+
+    def get_connection(self):
+        """Get the Vertica connection of the instance, open it if not opened yet"""
+        if self.connection is None or self.connection.closed():
+            self.connection = self.open_connection()
+            # Temp tables are dropped by vertica at the end of the session
+            self.temp_table = None
+        return self.connection
+
+    def close(self):
+        """Close the Vertica connection of the instance"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
 
-        return vertica.connect(**dict(conn_string))
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def query(self, query, params=None):
-        """Run a SQL query in vertica"""
+    def execute(self, query, params=None, cursor_type=None):
+        """Run a SQL statement on a new cursor and return the cursor
+
+        The session is reopened once if vertica closed it, for example while it was idle
+        between batches. query can be a function returning the statement if the statement
+        depends on the session, it is called again after reconnecting."""
+        import vertica_python as vertica  # pylint: disable=import-outside-toplevel
+
+        try:
+            return self._execute(query, params, cursor_type)
+        except vertica.errors.ConnectionError:
+            self.logger.warning("Connection to Vertica lost. Reconnecting...")
+            self.connection = None
+            return self._execute(query, params, cursor_type)
+
+    def _execute(self, query, params, cursor_type):
+        cur = self.get_connection().cursor(cursor_type)
+        if callable(query):
+            query = query()
         self.logger.debug("Running query: %s", query)
-        with self.open_connection() as connection:
-            with connection.cursor('dict') as cur:
-                cur.execute(query, parameters=params)
-                fetchall = format_json(cur.fetchall())
-                if cur.rowcount > 0:
-                    return fetchall
-                return []
+        cur.execute(query, parameters=params)
+        return cur
+
+    def query(self, query, params=None, as_dict=True):
+        """Run a SQL query in vertica
+
+        Rows are returned as dictionaries with JSON values formatted by default. With
+        as_dict=False rows are returned as plain lists by the default cursor, which is
+        cheaper for large metadata queries."""
+        with self.execute(query, params, 'dict' if as_dict else None) as cur:
+            fetchall = cur.fetchall()
+            if cur.rowcount > 0:
+                return format_json(fetchall) if as_dict else fetchall
+            return []
+
+    def run_statements(self, statements):
+        """Run multiple SQL statements in vertica in one round trip"""
+        with self.execute(';\n'.join(statements)) as cur:
+            # Errors of the subsequent statements are raised while reading their results
+            while cur.nextset():
+                pass
 
     def table_name(self, stream_name, is_temporary=False, without_schema=False):
         """Generate target table name"""
+        if is_temporary:
+            return '{}_{}'.format(TEMP_TABLE_PREFIX, next(TEMP_TABLE_SEQUENCE))
+
+        if self.stream_schema_message is not None and stream_name == self.stream_schema_message['stream']:
+            if without_schema:
+                return self.target_table_without_schema
+            return self.target_table
+
         stream_dict = stream_name_to_dict(stream_name)
         table_name = stream_dict['table_name']
         v_table_name = table_name.replace('.', '_').replace('-', '_').lower()
 
-        if is_temporary:
-            return 'tmp_{}'.format(str(uuid.uuid4()).replace('-', '_'))
-
         if without_schema:
             return f'"{v_table_name.lower()}"'
 
         return f'{self.schema_name}."{v_table_name.lower()}"'
 
-    def record_primary_key_string(self, record):
-        """Generate a unique PK string in the record"""
+    def flatten(self, record):
+        """Flatten a record according to the flatten schema of the stream"""
+        # Flattening is turned off by default, the record doesn't need to be walked recursively
+        if self.data_flattening_max_level == 0:
+            return self.record_flattener(record)
+
+        return flatten_record(record, json_columns=self.json_dump_columns,
+                              max_level=self.data_flattening_max_level)
+
+    def record_primary_key_string(self, flatten):
+        """Generate a unique PK string in the flattened record"""
         if len(self.stream_schema_message['key_properties']) == 0:
             return None
-        flatten = flatten_record(record, self.flatten_schema,
-                                 max_level=self.data_flattening_max_level)
         try:
             key_props = [str(flatten[p])
                          for p in self.stream_schema_message['key_properties']]
@@ -208,115 +357,131 @@ class DbSync:
             raise exc
         return ','.join(key_props)
 
-    # pylint: disable=missing-function-docstring,missing-class-docstring
-    def record_to_csv_line(self, record):
-        flatten = flatten_record(record, self.flatten_schema,
-                                 max_level=self.data_flattening_max_level)
-        return ','.join(
-            [
-                json.dumps(flatten[name], ensure_ascii=False)
-                if name in flatten and (flatten[name] == 0 or flatten[name]) else ''
-                for name in self.flatten_schema
-            ]
-        )
+    def record_to_csv_line_bytes(self, flatten):
+        """Generate an UTF-8 encoded CSV line from a flattened record"""
+        return self.csv_formatter(flatten)
+
+    # pylint: disable=invalid-name,unused-argument
+    def load_csv(self, file, count, size_bytes=None):
+        """Load CSV file into Vertica database
+
+        size_bytes is not used any more, the loaded size is measured while copying"""
+        with open(file, 'rb') as fs:
+            self.load_csv_batches([fs], count)
 
     # pylint: disable=invalid-name
-    def load_csv(self, file, count, size_bytes):
-        """Load CSV files into Vertica database"""
+    def load_csv_batches(self, buffers, count):
+        """Load an iterable of CSV buffers into Vertica database
+
+        Buffers are file-like objects, like open files or BytesIteratorReader streams.
+        Every buffer is streamed into the same temp table on a single connection
+        and the target table is updated from the temp table only once."""
         stream_schema_message = self.stream_schema_message
         stream = stream_schema_message['stream']
         self.logger.info("Loading %d rows into '%s'", count,
                          self.table_name(stream, False))
 
-        with self.open_connection() as connection:
-            with connection.cursor('dict') as cur:
-                inserts = 0
-                updates = 0
-
-                temp_table = self.table_name(
-                    stream_schema_message['stream'], is_temporary=True)
-                cur.execute(self.create_table_query(
-                    table_name=temp_table, is_temporary=True, is_flex=False))
-
-                cur.fetchall()
-                copy_sql = ("""COPY {table} FROM STDIN
-                                PARSER fcsvparser(
-                                            delimiter=',',
-                                            type='traditional',
-                                            header=false)
-                                ABORT ON ERROR"""
-                            .format(table=temp_table))
-                with open(file, 'rb') as fs:
-                    cur.copy(copy_sql, fs)
-
-                cur.fetchall()
-                if len(self.stream_schema_message['key_properties']) > 0:
-                    cur.execute(self.update_from_temp_table(temp_table))
-                    cur.fetchall()
-                    updates = cur.rowcount
+        with self.execute(self.prepare_temp_table_query, cursor_type='dict') as cur:
+            inserts = 0
+            merges = 0
+            temp_table = self.temp_table
+
+            # With copy_direct rows are written straight to ROS and rows that cannot be parsed
+            # are collected to a rejection table instead of aborting the whole batch
+            copy_direct = self.connection_config.get('copy_direct')
+            rejected_table = '{}.{}_rej'.format(self.schema_name, temp_table)
+            copy_sql = ("""COPY {table} FROM STDIN
+                            PARSER fcsvparser(
+                                        delimiter=',',
+                                        type='traditional',
+                                        header=false)
+                            {on_error}"""
+                        .format(table=temp_table,
+                                on_error='REJECTED DATA AS TABLE {} DIRECT'.format(rejected_table)
+                                if copy_direct else 'ABORT ON ERROR'))
+            rejected = 0
+            size_bytes = 0
+            for buffer in buffers:
+                cur.copy(copy_sql, buffer, buffer_size=COPY_BUFFER_SIZE)
+                size_bytes += buffer.tell()
+                if copy_direct:
+                    cur.execute('SELECT GET_NUM_REJECTED_ROWS() AS rejected')
+                    rejected += cur.fetchone()['rejected']
+
+            if rejected > 0:
+                cur.execute('SELECT rejected_reason, rejected_data FROM {} LIMIT 5'.format(rejected_table))
+                self.logger.warning("%d rows rejected while loading into '%s'. First rejections: %s",
+                                    rejected, self.table_name(stream, False), json.dumps(cur.fetchall()))
+            if copy_direct:
+                cur.execute('DROP TABLE IF EXISTS {}'.format(rejected_table))
+
+            # DML statements return the number of affected rows in a single OUTPUT row. MERGE returns
+            # the number of updated and inserted rows together, it's logged as merges and updates is 0
+            if len(self.stream_schema_message['key_properties']) > 0:
+                cur.execute(self.merge_from_temp_table(temp_table))
+                merges = cur.fetchone()['OUTPUT']
+            else:
                 cur.execute(self.insert_from_temp_table(temp_table))
-                cur.fetchall()
-                inserts = cur.rowcount
+                inserts = cur.fetchone()['OUTPUT']
 
-                self.logger.info('Loading into %s: %s',
-                                 self.table_name(stream, False),
-                                 json.dumps({'inserts': inserts, 'updates': updates, 'size_bytes': size_bytes}))
+            self.logger.info('Loading into %s: %s',
+                             self.table_name(stream, False),
+                             json.dumps({'inserts': inserts, 'updates': 0, 'merges': merges,
+                                         'size_bytes': size_bytes}))
 
-    # pylint: disable=duplicate-string-formatting-argument,bad-continuation
-    def insert_from_temp_table(self, temp_table):
-        """Insert non-temp table from aa temp table"""
-        stream_schema_message = self.stream_schema_message
-        columns = self.column_names()
-        table = self.table_name(stream_schema_message['stream'])
+    def prepare_temp_table_query(self):
+        """Generate SQL to create the temp table in a new session or to empty it for the next batch"""
+        if self.temp_table is None:
+            self.temp_table = self.table_name(self.stream_schema_message['stream'], is_temporary=True)
+            return self.create_table_query(table_name=self.temp_table, is_temporary=True, is_flex=False)
 
-        if len(stream_schema_message['key_properties']) == 0:
-            return """INSERT INTO {} ({}) (SELECT s.* FROM {} s)
-                    """.format(table, ', '.join(columns), temp_table)
+        return 'TRUNCATE TABLE {}'.format(self.temp_table)
 
-        return """INSERT INTO {} ({})
-                    (SELECT s.* FROM {} s LEFT OUTER JOIN {} t ON {} WHERE {})
-                """.format(table, ', '.join(columns), temp_table, table,
-                self.primary_key_condition('t'), self.primary_key_condition('t', null=True))
+    def insert_from_temp_table(self, temp_table):
+        """Insert non-temp table from a temp table"""
+        table = self.table_name(self.stream_schema_message['stream'])
+
+        return """INSERT INTO {} ({}) (SELECT s.* FROM {} s)
+                """.format(table, self.columns_sql, temp_table)
 
     # pylint: disable=bad-continuation
-    def update_from_temp_table(self, temp_table):
-        """Update non-temp table from aa temp table"""
-        stream_schema_message = self.stream_schema_message
-        columns = self.column_names()
-        table = self.table_name(stream_schema_message['stream'])
+    def merge_from_temp_table(self, temp_table):
+        """Update existing and insert new rows of non-temp table from a temp table in one statement"""
+        columns = self.safe_column_names
+        table = self.table_name(self.stream_schema_message['stream'])
+
+        # Primary key columns are matched in the ON clause, no need to update them
+        update_columns = [c for c in columns if c not in self.primary_key_names] or columns
 
-        return """UPDATE {table} SET {column_name} FROM {dataset} s WHERE {pk}
-                """.format(table=table, column_name=', '.join(['{}=s.{}'.format(c, c) for c in columns]),
-                dataset=temp_table, pk=self.primary_key_condition(table))
+        return """MERGE INTO {table} t USING {dataset} s ON {pk}
+                    WHEN MATCHED THEN UPDATE SET {set_columns}
+                    WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values})
+                """.format(table=table, dataset=temp_table, pk=self.primary_key_condition('t'),
+                set_columns=', '.join(['{0}=s.{0}'.format(c) for c in update_columns]),
+                columns=self.columns_sql, values=', '.join(['s.{}'.format(c) for c in columns]))
 
     def primary_key_condition(self, right_table, null=False):
         """Returns primary keys with/without null."""
-        stream_schema_message = self.stream_schema_message
-        names = primary_column_names(stream_schema_message)
-        if null:
-            return ' AND '.join(['{}.{} is null'.format(right_table, c) for c in names])
-        return ' AND '.join(['s.{} = {}.{}'.format(c, right_table, c) for c in names])
+        key = (right_table, null)
+        if key not in self.primary_key_conditions:
+            names = self.primary_key_names
+            if null:
+                condition = ' AND '.join(['{}.{} is null'.format(right_table, c) for c in names])
+            else:
+                condition = ' AND '.join(['s.{0} = {1}.{0}'.format(c, right_table) for c in names])
+            self.primary_key_conditions[key] = condition
+
+        return self.primary_key_conditions[key]
 
     def column_names(self, double_inverted_commas=True):
         """List of all column names"""
         if double_inverted_commas:
-            return [safe_column_name(name) for name in self.flatten_schema]
+            return self.safe_column_names
         return [str(name) for name in self.flatten_schema]
 
     def create_table_query(self, table_name=None, is_temporary=False, is_flex=False):
         """Generate CREATE TABLE SQL"""
         stream_schema_message = self.stream_schema_message
-        columns = [
-            column_clause(
-                name,
-                schema
-            )
-            for (name, schema) in self.flatten_schema.items()
-        ]
-
-        primary_key = ["PRIMARY KEY ({})".format(', '.join(
-            primary_column_names(stream_schema_message)))] if len(
-                stream_schema_message['key_properties']) > 0 else []
 
         if not table_name:
             gen_table_name = self.table_name(
@@ -326,7 +491,7 @@ class DbSync:
             'FLEX ' if is_flex else '',
             'TEMPORARY ' if is_temporary else '',
             table_name if table_name else gen_table_name,
-            ', '.join(columns + primary_key),
+            self.column_clauses_sql,
             ' ON COMMIT PRESERVE ROWS' if is_temporary else '',
         )
 
@@ -391,19 +556,23 @@ class DbSync:
     def create_schema_if_not_exists(self, table_columns_cache=None):
         """Create target schema if not exists"""
         schema_name = self.schema_name
+        schema_name_lower = self.schema_name_lower
         schema_rows = 0
 
-        # table_columns_cache is an optional pre-collected list of available objects in vertica
-        if table_columns_cache:
-            schema_rows = list(
-                filter(lambda x: x['TABLE_SCHEMA'] == schema_name, table_columns_cache))
-        # Query realtime if not pre-collected
+        # table_columns_cache is an optional pre-collected dict of available objects in vertica
+        if table_columns_cache is None:
+            table_columns_cache = self.table_cache
+
+        # Schemas without tables are not in the cache, query realtime if not pre-collected
+        if table_columns_cache and table_columns_cache.get(schema_name_lower):
+            schema_rows = [(schema_name_lower,)]
         else:
             schema_rows = self.query(
                 """SELECT LOWER(schema_name) schema_name
                     FROM v_catalog.schemata
                     WHERE LOWER(schema_name) = %s""",
-                (schema_name.lower(),)
+                (schema_name_lower,),
+                as_dict=False
             )
 
         if len(schema_rows) == 0:
@@ -414,20 +583,57 @@ class DbSync:
             self.grant_privilege(schema_name, self.grantees,
                                  self.grant_usage_on_schema)
 
+    def load_catalog_cache(self, schema_names):
+        """Get the columns of every table of certain schema(s) from vertica metadata in one query"""
+        table_cache = {schema_name.lower(): {} for schema_name in schema_names}
+        if not table_cache:
+            return table_cache
+
+        rows = self.query(
+            """SELECT lower(table_schema) table_schema, lower(table_name) table_name, column_name, data_type
+                FROM v_catalog.columns
+                WHERE lower(table_schema) IN ({})""".format(', '.join(['%s'] * len(table_cache))),
+            tuple(table_cache.keys()),
+            as_dict=False
+        )
+        for table_schema, table_name, column_name, data_type in rows:
+            table_cache[table_schema].setdefault(table_name, []).append((column_name, data_type))
+
+        return table_cache
+
     def get_tables(self):
         """Get list of tables of certain schema(s) from vertica metadata"""
+        if self.table_cache is not None and self.schema_name_lower in self.table_cache:
+            return [(table_name,) for table_name in self.table_cache[self.schema_name_lower]]
+
         return self.query(
-            """SELECT table_name FROM v_catalog.tables WHERE table_schema = %s""",
-            (self.schema_name,)
+            """SELECT table_name FROM v_catalog.tables WHERE lower(table_schema) = %s""",
+            (self.schema_name_lower,),
+            as_dict=False
         )
 
-    def get_table_columns(self, table_name):
+    def get_table_columns(self, table_name, use_cache=True):
         """Get list of columns and tables of certain schema(s) from vertica metadata"""
-        return self.query(
+        table_name = table_name.replace("\"", "").lower()
+        schema_tables = self.table_cache.get(self.schema_name_lower) if self.table_cache is not None else None
+        if use_cache and schema_tables and table_name in schema_tables:
+            return schema_tables[table_name]
+
+        columns = self.query(
             """SELECT column_name, data_type FROM v_catalog.columns
                 WHERE lower(table_name) = %s AND lower(table_schema) = %s""",
-            (table_name.replace("\"", "").lower(), self.schema_name.lower())
+            (table_name, self.schema_name_lower),
+            as_dict=False
         )
+        if schema_tables is not None and columns:
+            schema_tables[table_name] = columns
+
+        return columns
+
+    def update_table_cache(self, stream):
+        """Refresh the cached columns of the target table after altering it"""
+        if self.table_cache is not None:
+            self.get_table_columns(self.table_name(stream, without_schema=True), use_cache=False)
 
     @staticmethod
     def data_types_equal(input_data_type: str, db_data_type: str) -> bool:
@@ -446,7 +652,7 @@ class DbSync:
         table_name = self.table_name(stream, without_schema=True)
         columns = self.get_table_columns(table_name)
         columns_dict = {
-            column['column_name'].lower(): column for column in columns}
+            column_name.lower(): data_type for column_name, data_type in columns}
 
         columns_to_add = []
         for (name, properties_schema) in self.flatten_schema.items():
@@ -454,23 +660,30 @@ class DbSync:
                 columns_to_add.append(
                     column_clause(name, properties_schema))
 
-        for column in columns_to_add:
-            self.add_column(column, stream)
-
         columns_to_replace = []
         for (name, properties_schema) in self.flatten_schema.items():
-            db_data_type = columns_dict[name.lower()]['data_type'].lower()
+            if name.lower() not in columns_dict:
+                continue
+            db_data_type = columns_dict[name.lower()].lower()
             input_data_type = column_type(properties_schema).lower()
-            if name.lower() in columns_dict and not self.data_types_equal(input_data_type, db_data_type):
+            if not self.data_types_equal(input_data_type, db_data_type):
                 LOGGER.debug(
                     f"Replace column {name.lower()} db_data_type={db_data_type} input_data_type={input_data_type}"
                 )
                 columns_to_replace.append(
                     (safe_column_name(name), column_clause(name, properties_schema)))
 
+        # ADD COLUMN cannot be combined with other clauses in one ALTER TABLE in vertica.
+        # Send every ALTER TABLE statement in one round trip instead.
+        statements = [self.add_column_query(column, stream) for column in columns_to_add]
         for (column_name, column) in columns_to_replace:
-            self.version_column(column_name, stream)
-            self.add_column(column, stream)
+            statements.append(self.version_column_query(column_name, stream))
+            statements.append(self.add_column_query(column, stream))
+
+        if statements:
+            self.logger.info('Altering table: %s', '; '.join(statements))
+            self.run_statements(statements)
+            self.update_table_cache(stream)
 
     def drop_column(self, column_name, stream):
         """Drops column from an existing table"""
@@ -478,21 +691,32 @@ class DbSync:
             self.table_name(stream), column_name)
         self.logger.info('Dropping column: %s', drop_column)
         self.query(drop_column)
+        self.update_table_cache(stream)
 
-    def version_column(self, column_name, stream):
-        """Versions a column in an existing table"""
-        version_column = "ALTER TABLE {} RENAME COLUMN {} TO \"{}_{}\""\
+    def version_column_query(self, column_name, stream):
+        """Generate ALTER TABLE SQL to version a column"""
+        return "ALTER TABLE {} RENAME COLUMN {} TO \"{}_{}\""\
             .format(self.table_name(stream, False), column_name, column_name.replace("\"", ""),
                     time.strftime("%Y%m%d_%H%M"))
+
+    def version_column(self, column_name, stream):
+        """Versions a column in an existing table"""
+        version_column = self.version_column_query(column_name, stream)
         self.logger.info('Versioning column: %s', version_column)
         self.query(version_column)
+        self.update_table_cache(stream)
+
+    def add_column_query(self, column, stream):
+        """Generate ALTER TABLE SQL to add a new column"""
+        return "ALTER TABLE {} ADD COLUMN {}".format(
+            self.table_name(stream), column)
 
     def add_column(self, column, stream):
         """Adds a new column to an existing table"""
-        add_column = "ALTER TABLE {} ADD COLUMN {}".format(
-            self.table_name(stream), column)
+        add_column = self.add_column_query(column, stream)
         self.logger.info('Adding column: %s', add_column)
         self.query(add_column)
+        self.update_table_cache(stream)
 
     def sync_table(self):
         """Creates or alters the target table according to the schema"""
@@ -500,11 +724,12 @@ class DbSync:
         stream = stream_schema_message['stream']
         table_name = self.table_name(stream, is_temporary=False, without_schema=True)
         found_tables = [table for table in (
-            self.get_tables()) if f'"{table["table_name"].lower()}"' == table_name]
+            self.get_tables()) if f'"{table[0].lower()}"' == table_name]
         if len(found_tables) == 0:
             query = self.create_table_query()
             self.logger.info("Table '%s' does not exist. Creating... %s", table_name, query)
             self.query(query)
+            self.update_table_cache(stream)
 
             self.grant_privilege(
                 self.schema_name, self.grantees, self.grant_select_on_all_tables_in_schema)
@@ -1,13 +1,11 @@
+import io
 import sys
 import json
-import ast
+import functools
 import re
-import itertools
+import time
 import inflection
-if sys.version_info.major == 3 and sys.version_info.minor >= 10:
-    from collections.abc import MutableMapping
-else:
-    from collections import MutableMapping
+import orjson
 
 from decimal import Decimal
 from singer import get_logger
@@ -20,18 +18,39 @@ LOGGER = get_logger('target_vertica')
 
 DEFAULT_VARCHAR_LENGTH = 1024
 LONG_VARCHAR_LENGTH = 65000
+# Flattened keys longer than this are shortened
+MAX_FLATTEN_KEY_LENGTH = 63
+RE_LOWER_CASE_LETTERS = re.compile(r'[a-z]')
+
+# Fallback _sdc_batched_at value, refreshed at most every BATCHED_AT_CACHE_SECONDS
+BATCHED_AT_CACHE_SECONDS = 0.01
+_BATCHED_AT_CACHE = {'ts': float('-inf'), 'iso': ''}
 
 
 def float_to_decimal(value):
     """Walk the given data structure and turn all instances of float into
-    double."""
+    double.
+
+    Nested lists and dicts are walked with an explicit stack instead of
+    recursion, containers are shallow copied before they are changed."""
     if isinstance(value, float):
         return Decimal(str(value))
-    if isinstance(value, list):
-        return [float_to_decimal(child) for child in value]
-    if isinstance(value, dict):
-        return {k: float_to_decimal(v) for k, v in value.items()}
-    return value
+    if not isinstance(value, (dict, list)):
+        return value
+
+    root = value.copy()
+    stack = [root]
+    while stack:
+        container = stack.pop()
+        for key, child in (container.items() if isinstance(container, dict) else enumerate(container)):
+            if isinstance(child, float):
+                container[key] = Decimal(str(child))
+            elif isinstance(child, (dict, list)):
+                child = child.copy()
+                container[key] = child
+                stack.append(child)
+
+    return root
 
 
 def add_metadata_columns_to_schema(schema_message):
@@ -51,15 +70,24 @@ def add_metadata_columns_to_schema(schema_message):
     return extended_schema_message
 
 
-def add_metadata_values_to_record(record_message):
+def add_metadata_values_to_record(record_message, batched_at=None):
     """Populate metadata _sdc columns from incoming record message
     The location of the required attributes are fixed in the stream
+
+    batched_at is the ISO formatted time of the current batch, if not defined
+    the current time is used with BATCHED_AT_CACHE_SECONDS granularity
     """
+    if batched_at is None:
+        now = time.monotonic()
+        if now - _BATCHED_AT_CACHE['ts'] > BATCHED_AT_CACHE_SECONDS:
+            _BATCHED_AT_CACHE['ts'] = now
+            _BATCHED_AT_CACHE['iso'] = datetime.now().isoformat()
+        batched_at = _BATCHED_AT_CACHE['iso']
+
     extended_record = record_message['record']
     extended_record['_sdc_extracted_at'] = record_message.get('time_extracted')
-    extended_record['_sdc_batched_at'] = datetime.now().isoformat()
-    extended_record['_sdc_deleted_at'] = record_message.get(
-        'record', {}).get('_sdc_deleted_at')
+    extended_record['_sdc_batched_at'] = batched_at
+    extended_record['_sdc_deleted_at'] = extended_record.get('_sdc_deleted_at')
 
     return extended_record
 
@@ -68,13 +96,56 @@ def emit_state(state):
     """Emit state message to standard output then it can be
     consumed by other components"""
     if state is not None:
-        line = json.dumps(state)
+        line = json.dumps(state, separators=(',', ':'))
         LOGGER.debug('Emitting state %s', line)
-        sys.stdout.write("{}\n".format(line))
-        sys.stdout.flush()
+        # Write bytes straight to the binary buffer unless stdout has been replaced by a text-only stream
+        stdout = getattr(sys.stdout, 'buffer', None)
+        if stdout is None:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+        else:
+            stdout.write(line.encode('utf-8') + b'\n')
+            stdout.flush()
 
 
 # ========= DBSYNC UTILS BELOW  =========
+class BytesIteratorReader(io.RawIOBase):
+    """Read-only file-like object over an iterator of bytes chunks
+
+    Chunks are pulled from the iterator only when they are read, so records can be
+    streamed into COPY FROM STDIN without writing them to a temporary file first."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.pending = b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        length = len(self.pending)
+        while size is None or size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+
+        data = b''.join(parts)
+        if size is not None and 0 <= size < length:
+            data, self.pending = data[:size], data[size:]
+        else:
+            self.pending = b''
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
 def validate_config(config):
     """Validate configuration"""
     errors = []
@@ -88,26 +159,27 @@ def validate_config(config):
 
     # Check if mandatory keys exist
     for k in required_config_keys:
-        if not config.get(k, None):
+        if not config.get(k):
             errors.append(
                 "Required key is missing from config: [{}]".format(k))
 
     # Check target schema config
-    config_default_target_schema = config.get('default_target_schema', None)
-    config_schema_mapping = config.get('schema_mapping', None)
+    config_default_target_schema = config.get('default_target_schema')
+    config_schema_mapping = config.get('schema_mapping')
     if not config_default_target_schema and not config_schema_mapping:
         errors.append(
             "Neither 'default_target_schema' (string) nor 'schema_mapping' (object) keys set in config.")
 
     return errors
 
+
 # pylint: disable=fixme,too-many-branches
 def column_type(schema_property, with_length=True):
     # TODO: Data type for semi-structured data like json, xml. Vertica uses flex table for the same.
     """Take a specific schema property and return the vertica equivalent column type"""
 
     property_type = schema_property['type']
-    property_format = schema_property['format'] if 'format' in schema_property else None
+    property_format = schema_property.get('format')
     col_type = 'varchar'
     varchar_length = DEFAULT_VARCHAR_LENGTH
     if schema_property.get('maxLength', 0) > varchar_length:
@@ -129,12 +201,13 @@ def column_type(schema_property, with_length=True):
     elif 'integer' in property_type and 'string' in property_type:
         col_type = 'varchar'
     elif 'integer' in property_type:
-        if 'maximum' in schema_property:
-            if schema_property['maximum'] <= 32767:
+        maximum = schema_property.get('maximum')
+        if maximum is not None:
+            if maximum <= 32767:
                 col_type = 'smallint'
-            elif schema_property['maximum'] <= 2147483647:
+            elif maximum <= 2147483647:
                 col_type = 'int'
-            elif schema_property['maximum'] <= 9223372036854775807:
+            elif maximum <= 9223372036854775807:
                 col_type = 'bigint'
         else:
             col_type = 'int'
@@ -152,9 +225,10 @@ def column_type(schema_property, with_length=True):
     return col_type
 
 
+@functools.lru_cache(maxsize=4096)
 def safe_column_name(name):
     """Generate SQL friendly column name"""
-    return '"{}"'.format(name).lower()
+    return f'"{name.lower()}"'
 
 
 def column_clause(name, schema_property):
@@ -162,14 +236,25 @@ def column_clause(name, schema_property):
     return '{} {}'.format(safe_column_name(name), column_type(schema_property))
 
 
+@functools.lru_cache(maxsize=4096)
+def reduce_key_token(token):
+    """Shorten a token of a flattened key to the capital letters of its camelized form"""
+    return RE_LOWER_CASE_LETTERS.sub('', inflection.camelize(token))
+
+
 # pylint: disable=missing-function-docstring,missing-class-docstring
+@functools.lru_cache(maxsize=8192)
 def flatten_key(k, parent_key, sep):
-    full_key = parent_key + [k]
-    inflected_key = full_key.copy()
+    # parent_key is a tuple to be hashable, the same keys are flattened for every record
+    full_key = parent_key + (k,)
+    joined_key = sep.join(full_key)
+    if len(joined_key) < MAX_FLATTEN_KEY_LENGTH:
+        return joined_key
+
+    inflected_key = list(full_key)
     reducer_index = 0
-    while len(sep.join(inflected_key)) >= 63 and reducer_index < len(inflected_key):
-        reduced_key = re.sub(
-            r'[a-z]', '', inflection.camelize(inflected_key[reducer_index]))
+    while len(sep.join(inflected_key)) >= MAX_FLATTEN_KEY_LENGTH and reducer_index < len(inflected_key):
+        reduced_key = reduce_key_token(inflected_key[reducer_index])
         inflected_key[reducer_index] = \
             (reduced_key if len(reduced_key) >
              1 else inflected_key[reducer_index][0:3]).lower()
@@ -179,8 +264,9 @@ def flatten_key(k, parent_key, sep):
 
 
 # pylint: disable=dangerous-default-value,invalid-name,missing-function-docstring,missing-class-docstring
-def flatten_schema(d, parent_key=[], sep='__', level=0, max_level=0):
+def flatten_schema(d, parent_key=(), sep='__', level=0, max_level=0):
     items = []
+    parent_key = tuple(parent_key)
 
     if 'properties' not in d:
         return {}
@@ -190,57 +276,90 @@ def flatten_schema(d, parent_key=[], sep='__', level=0, max_level=0):
         if 'type' in v.keys():
             if 'object' in v['type'] and 'properties' in v and level < max_level:
                 items.extend(flatten_schema(
-                    v, parent_key + [k], sep=sep, level=level + 1, max_level=max_level).items())
+                    v, parent_key + (k,), sep=sep, level=level + 1, max_level=max_level).items())
             else:
                 items.append((new_key, v))
         else:
             if len(v.values()) > 0:
-                if list(v.values())[0][0]['type'] == 'string':
-                    list(v.values())[0][0]['type'] = ['null', 'string']
-                    items.append((new_key, list(v.values())[0][0]))
-                elif list(v.values())[0][0]['type'] == 'array':
-                    list(v.values())[0][0]['type'] = ['null', 'array']
-                    items.append((new_key, list(v.values())[0][0]))
-                elif list(v.values())[0][0]['type'] == 'object':
-                    list(v.values())[0][0]['type'] = ['null', 'object']
-                    items.append((new_key, list(v.values())[0][0]))
-
-    def key_func(item):
-        return item[0]
-
-    sorted_items = sorted(items, key=key_func)
-    for k, g in itertools.groupby(sorted_items, key=key_func):
-        if len(list(g)) > 1:
+                first = next(iter(v.values()))[0]
+                if first['type'] == 'string':
+                    first['type'] = ['null', 'string']
+                    items.append((new_key, first))
+                elif first['type'] == 'array':
+                    first['type'] = ['null', 'array']
+                    items.append((new_key, first))
+                elif first['type'] == 'object':
+                    first['type'] = ['null', 'object']
+                    items.append((new_key, first))
+
+    seen = set()
+    for k, _ in items:
+        if k in seen:
             raise ValueError(
                 'Duplicate column name produced in schema: {}'.format(k))
+        seen.add(k)
+
+    # Columns are kept in sorted order, table DDL and CSV lines follow it
+    return dict(sorted(items, key=lambda item: item[0]))
 
-    return dict(sorted_items)
+
+def json_dumps(value):
+    """Serialise a nested object or array of a record to a compact JSON string"""
+    try:
+        return orjson.dumps(value).decode('utf-8')
+    except orjson.JSONEncodeError:
+        # Values orjson can't encode, like integers above 64 bits, fall back to the json module
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
 
 
 # pylint: disable=redefined-outer-name
-def _should_json_dump_value(key, value, flatten_schema=None):
-    if isinstance(value, (dict, list)):
-        return True
+def json_dump_columns(flatten_schema):
+    """Names of the columns that are always JSON dumped according to the flatten schema"""
+    return frozenset(key for key, value in flatten_schema.items()
+                     if 'type' in value and set(value['type']) == {'null', 'object', 'array'})
 
-    if flatten_schema and key in flatten_schema and 'type' in flatten_schema[key]\
-            and set(flatten_schema[key]['type']) == {'null', 'object', 'array'}:
-        return True
 
-    return False
+# pylint: disable=too-many-arguments
+def _flatten_record_into(flatten, d, json_columns, parent_key, sep, level, max_level):
+    for k, v in d.items():
+        if isinstance(v, dict) and level < max_level:
+            _flatten_record_into(flatten, v, json_columns, parent_key + (k,), sep, level + 1, max_level)
+        else:
+            flatten[flatten_key(k, parent_key, sep)] = \
+                json_dumps(v) if isinstance(v, (dict, list)) or k in json_columns else v
 
 
 # pylint: disable-msg=too-many-arguments,missing-function-docstring,missing-class-docstring
-def flatten_record(d, flatten_schema=None, parent_key=[], sep='__', level=0, max_level=0):
-    items = []
-    for k, v in d.items():
-        new_key = flatten_key(k, parent_key, sep)
-        if isinstance(v, MutableMapping) and level < max_level:
-            items.extend(flatten_record(v, flatten_schema, parent_key + [k], sep=sep, level=level + 1,
-                                        max_level=max_level).items())
+def flatten_record(d, flatten_schema=None, parent_key=(), sep='__', level=0, max_level=0, json_columns=None):
+    """Flatten a record, json_columns are the precomputed json_dump_columns of flatten_schema"""
+    if json_columns is None:
+        json_columns = json_dump_columns(flatten_schema) if flatten_schema else frozenset()
+
+    flatten = {}
+    _flatten_record_into(flatten, d, json_columns, tuple(parent_key), sep, level, max_level)
+    return flatten
+
+
+# pylint: disable=exec-used
+def compile_flatten_record(property_names, json_columns=frozenset(), sep='__'):
+    """Generate a function that does the same as flatten_record with max_level=0 for known properties
+
+    The generated function has one statement per property, keys of the record
+    that are not in property_names are not copied into the flattened record."""
+    source = 'def flatten_record_compiled(d):\n    flatten = {}\n'
+    for k in property_names:
+        column = k if len(k) < MAX_FLATTEN_KEY_LENGTH else flatten_key(k, (), sep)
+        source += '    if {!r} in d:\n'.format(k)
+        if k in json_columns:
+            source += '        flatten[{!r}] = dumps(d[{!r}])\n'.format(column, k)
         else:
-            items.append((new_key, json.dumps(
-                v) if _should_json_dump_value(k, v, flatten_schema) else v))
-    return dict(items)
+            source += '        v = d[{!r}]\n'.format(k)
+            source += '        flatten[{!r}] = dumps(v) if isinstance(v, (dict, list)) else v\n'.format(column)
+    source += '    return flatten\n'
+
+    namespace = {}
+    exec(compile(source, '<flatten_record>', 'exec'), {'dumps': json_dumps}, namespace)
+    return namespace['flatten_record_compiled']
 
 
 def primary_column_names(stream_schema_message):
@@ -271,19 +390,34 @@ def stream_name_to_dict(stream_name, separator='-'):
     }
 
 
+def _looks_like_json(value):
+    """Check if a query result value is a string holding a JSON object or array"""
+    return (isinstance(value, str) and value and (value[0] == '[' and value[-1] == ']'
+                                                  or value[0] == '{' and value[-1] == '}'))
+
+
+def _parse_json(value):
+    """Parse a JSON string, strings that are not valid JSON are returned as they are"""
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return value
+
+
 def format_json(data, ordered=True):
     # INFO: Maybe not required if semi structured data is stored in flex table.
-    """Format string into json/dictionary/list."""
+    """Format string into json/dictionary/list.
+
+    Every distinct JSON string is parsed only once, rows with the same value share the parsed object."""
     if data and isinstance(data, list) and isinstance(data[0], dict):
-        for index, item in enumerate(data.copy()):
-            for k, v in dict(item).items():
-                if (isinstance(v, str) and (v[0] == '[' and v[-1] == ']'
-                                            or v[0] == '{' and v[-1] == '}')):
-                    try:
-                        data[index][k] = ast.literal_eval(v)
-                    except ValueError:
-                        pass
-        if not ordered:
-            for index, item in enumerate(data.copy()):
-                data[index] = dict(item)
+        parsed = {}
+        for item in data:
+            for k, v in item.items():
+                if _looks_like_json(v):
+                    if v not in parsed:
+                        parsed[v] = _parse_json(v)
+                    item[k] = parsed[v]
+        # Plain dicts are already insertion ordered, only OrderedDict rows of dict cursors need rebuilding
+        if not ordered and type(data[0]) is not dict:  # pylint: disable=unidiomatic-typecheck
+            data[:] = [dict(item) for item in data]
     return data
@@ -1,9 +1,39 @@
+import io
+import tempfile
 import unittest
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
 from nose.tools import assert_raises
 
 import target_vertica
 
 
+MINIMAL_CONFIG = {
+    'host':                     "dummy-value",
+    'port':                     5433,
+    'user':                     "dummy-value",
+    'password':                 "dummy-value",
+    'dbname':                   "dummy-value",
+    'default_target_schema':    "my_schema"
+}
+
+
+def _mock_connection(fetchone=None):
+    """Vertica connection mock, every cursor is the same mock to collect the executed statements"""
+    connection = MagicMock()
+    connection.closed.return_value = False
+    cursor = connection.cursor.return_value
+    cursor.__enter__.return_value = cursor
+    cursor.fetchone.return_value = fetchone or {'OUTPUT': 1}
+    # COPY reads the whole buffer
+    cursor.copy.side_effect = lambda sql, buffer, buffer_size: buffer.read()
+    return connection
+
+
+def _executed_statements(connection):
+    return [call.args[0] for call in connection.cursor.return_value.execute.call_args_list]
+
+
 class TestUnit(unittest.TestCase):
     """
     Unit Tests
@@ -240,7 +270,7 @@ class TestUnit(unittest.TestCase):
                 "c_pk": 1,
                 "c_varchar": "1",
                 "c_int": 1,
-                "c_obj": '{"nested_prop1": "value_1", "nested_prop2": "value_2", "nested_prop3": {"multi_nested_prop1": "multi_value_1", "multi_nested_prop2": "multi_value_2"}}'
+                "c_obj": '{"nested_prop1":"value_1","nested_prop2":"value_2","nested_prop3":{"multi_nested_prop1":"multi_value_1","multi_nested_prop2":"multi_value_2"}}'
             }
 
         # NO FLATTENNING
@@ -251,7 +281,7 @@ class TestUnit(unittest.TestCase):
                 "c_pk": 1,
                 "c_varchar": "1",
                 "c_int": 1,
-                "c_obj": '{"nested_prop1": "value_1", "nested_prop2": "value_2", "nested_prop3": {"multi_nested_prop1": "multi_value_1", "multi_nested_prop2": "multi_value_2"}}'
+                "c_obj": '{"nested_prop1":"value_1","nested_prop2":"value_2","nested_prop3":{"multi_nested_prop1":"multi_value_1","multi_nested_prop2":"multi_value_2"}}'
             }
 
         # SEMI FLATTENNING
@@ -264,7 +294,7 @@ class TestUnit(unittest.TestCase):
                 "c_int": 1,
                 "c_obj__nested_prop1": "value_1",
                 "c_obj__nested_prop2": "value_2",
-                "c_obj__nested_prop3": '{"multi_nested_prop1": "multi_value_1", "multi_nested_prop2": "multi_value_2"}'
+                "c_obj__nested_prop3": '{"multi_nested_prop1":"multi_value_1","multi_nested_prop2":"multi_value_2"}'
             }
 
         # FLATTENNING
@@ -321,3 +351,397 @@ class TestUnit(unittest.TestCase):
         for idx, (should_use_flatten_schema, record, expected_output) in enumerate(test_cases):
             output = flatten_record(record, flatten_schema if should_use_flatten_schema else None)
             assert output == expected_output
+
+            # Precomputed JSON dump columns give the same result as the flatten schema
+            json_columns = target_vertica.db_sync.json_dump_columns(flatten_schema)
+            output = flatten_record(record, json_columns=json_columns if should_use_flatten_schema else None)
+            assert output == expected_output
+
+    def test_compile_flatten_record(self):
+        """Test the generated flattener is the same as flatten_record without flattening"""
+        flatten_record = target_vertica.db_sync.flatten_record
+        json_dump_columns = target_vertica.db_sync.json_dump_columns
+
+        flatten_schema = {
+            "c_pk": {"type": ["null", "integer"]},
+            "c_json": {"type": ["null", "object", "array"]}
+        }
+        record = {
+            "c_pk": 1,
+            "c_json": 2,
+            "c_obj": {"nested_prop1": "value_1", "nested_prop2": [1, 2]},
+            "c_" + "very_long_column_name" * 4: "value_2"
+        }
+
+        # Missing properties are not added to the flattened record
+        flatten_record_compiled = target_vertica.utils.compile_flatten_record(
+            list(record) + ["c_missing"], json_dump_columns(flatten_schema))
+        assert flatten_record_compiled(record) == flatten_record(record, flatten_schema, max_level=0)
+
+        # Record keys that are not known properties are not copied
+        flatten_record_compiled = target_vertica.utils.compile_flatten_record(["c_pk"])
+        assert flatten_record_compiled(record) == {"c_pk": 1}
+
+    def test_record_to_csv_line_bytes(self):
+        """Test generating CSV lines from flattened records"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": ["c_pk"],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_pk": {"type": ["null", "integer"]},
+                    "c_bool": {"type": ["null", "boolean"]},
+                    "c_varchar": {"type": ["null", "string"]},
+                    "c_int": {"type": ["null", "integer"]}}}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+
+        # Columns are following the order of the flatten schema, NULLs and missing values are empty
+        assert \
+            dbsync.record_to_csv_line_bytes({"c_pk": 1, "c_bool": False, "c_varchar": "a,b \"c\" é"}) == \
+            b'false,,1,"a,b \\"c\\" \xc3\xa9"'
+
+        # Integers out of the 64-bit range are still encoded
+        assert \
+            dbsync.record_to_csv_line_bytes({"c_pk": 0, "c_int": 2 ** 70}) == \
+            b',1180591620717411303424,0,'
+
+        # Non-finite floats are kept as NaN and Infinity that vertica FLOAT columns accept
+        csv_value = target_vertica.db_sync.csv_value
+        assert csv_value(float('nan')) == b'NaN'
+        assert csv_value(float('inf')) == b'Infinity'
+        assert csv_value(float('-inf')) == b'-Infinity'
+        assert csv_value(1.5) == b'1.5'
+
+    def test_table_cache(self):
+        """Test serving table columns from the pre-collected catalog cache"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": ["c_pk"],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_pk": {"type": ["null", "integer"]}}}}
+        catalog_rows = [
+            ['my_schema', 'my_table', 'c_pk', 'int'],
+            ['my_schema', 'my_table', 'c_str', 'varchar(1024)'],
+        ]
+
+        with patch.object(target_vertica.db_sync.DbSync, 'query', return_value=catalog_rows) as query_mock:
+            table_cache = target_vertica.db_sync.DbSync(MINIMAL_CONFIG).load_catalog_cache(['My_Schema', 'other'])
+            query_mock.assert_called_once()
+
+            assert table_cache == {
+                'my_schema': {
+                    'my_table': [('c_pk', 'int'), ('c_str', 'varchar(1024)')]},
+                'other': {}}
+
+            # Cached tables and columns should not hit the database
+            dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message, table_cache)
+            assert dbsync.get_tables() == [('my_table',)]
+            assert dbsync.get_table_columns('"my_table"') == table_cache['my_schema']['my_table']
+            query_mock.assert_called_once()
+
+    def test_bytes_iterator_reader(self):
+        """Test reading an iterator of bytes chunks as a file-like object"""
+        reader = target_vertica.utils.BytesIteratorReader(iter([b'1,a\n', b'', b'2,bb\n', b'3,ccc\n']))
+
+        # Chunks are split and joined to return the requested size
+        assert reader.read(2) == b'1,'
+        assert reader.read(5) == b'a\n2,b'
+        assert reader.tell() == 7
+        assert reader.read() == b'b\n3,ccc\n'
+        assert reader.read(10) == b''
+        assert reader.tell() == 15
+
+    def test_float_to_decimal(self):
+        """Test turning floats into decimals in nested data structures"""
+        float_to_decimal = target_vertica.utils.float_to_decimal
+
+        record = {"c_float": 1.1, "c_int": 1, "c_obj": {"c_list": [2.2, "3.3", {"c_float": 4.4}]}}
+        expected = {"c_float": Decimal('1.1'), "c_int": 1,
+                    "c_obj": {"c_list": [Decimal('2.2'), "3.3", {"c_float": Decimal('4.4')}]}}
+
+        # The original record should not change
+        assert float_to_decimal(record) == expected
+        assert record["c_obj"]["c_list"][2]["c_float"] == 4.4
+
+        assert float_to_decimal(5.5) == Decimal('5.5')
+
+    def test_format_json(self):
+        """Test parsing JSON strings of query results into objects and arrays"""
+        format_json = target_vertica.utils.format_json
+
+        rows = [{"c_obj": '{"key": "value"}', "c_list": '[1, 2]', "c_str": "[not json]", "c_int": 1},
+                {"c_obj": '{}', "c_list": None, "c_str": "", "c_int": 2}]
+
+        assert format_json(rows) is rows
+        assert rows == [{"c_obj": {"key": "value"}, "c_list": [1, 2], "c_str": "[not json]", "c_int": 1},
+                        {"c_obj": {}, "c_list": None, "c_str": "", "c_int": 2}]
+        assert format_json([]) == []
+
+        # Repeated values are parsed once
+        rows = [{"c_obj": '{"key": "value"}'}, {"c_obj": '{"key": "value"}'}]
+        assert format_json(rows) == [{"c_obj": {"key": "value"}}, {"c_obj": {"key": "value"}}]
+        assert rows[0]["c_obj"] is rows[1]["c_obj"]
+
+    def test_emit_state(self):
+        """Test emitting state as compact JSON lines"""
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with patch('sys.stdout', stdout):
+            target_vertica.utils.emit_state({"bookmarks": {"tap_mysql_test-test_table_one": {"id": 1}}})
+            target_vertica.utils.emit_state(None)
+
+        assert stdout.buffer.getvalue() == b'{"bookmarks":{"tap_mysql_test-test_table_one":{"id":1}}}\n'
+
+    def test_json_dumps(self):
+        """Test serialising nested values to compact JSON strings"""
+        json_dumps = target_vertica.utils.json_dumps
+
+        assert json_dumps({"key": ["árvíztűrő", 1]}) == '{"key":["árvíztűrő",1]}'
+        # Integers above 64 bits are not supported by orjson
+        assert json_dumps([2 ** 64]) == '[18446744073709551616]'
+
+    def test_add_metadata_values_to_record_batched_at_cache(self):
+        """Test reusing the fallback _sdc_batched_at value within BATCHED_AT_CACHE_SECONDS"""
+        add_metadata_values_to_record = target_vertica.utils.add_metadata_values_to_record
+
+        def batched_at():
+            return add_metadata_values_to_record({'record': {}})['_sdc_batched_at']
+
+        with patch('target_vertica.utils.time.monotonic') as monotonic_mock, \
+                patch('target_vertica.utils.datetime') as datetime_mock, \
+                patch.dict(target_vertica.utils._BATCHED_AT_CACHE, {'ts': float('-inf'), 'iso': ''}):
+            datetime_mock.now.return_value.isoformat.side_effect = ['2020-01-01T00:00:00', '2020-01-01T00:00:01']
+
+            monotonic_mock.return_value = 100.0
+            assert batched_at() == '2020-01-01T00:00:00'
+            # Inside the window the cached value is reused
+            monotonic_mock.return_value = 100.005
+            assert batched_at() == '2020-01-01T00:00:00'
+            # After the window the value is refreshed
+            monotonic_mock.return_value = 100.02
+            assert batched_at() == '2020-01-01T00:00:01'
+            assert datetime_mock.now.call_count == 2
+
+            # The batch value is used when defined
+            assert add_metadata_values_to_record({'record': {}}, 'batch')['_sdc_batched_at'] == 'batch'
+
+    def test_reconnect_lost_session(self):
+        """Test reopening a session that vertica closed before loading the next batch"""
+        import vertica_python
+
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": [],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_int": {"type": ["null", "integer"]}}}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+
+        # The session of the previous batch was closed by vertica while idle
+        lost_connection = _mock_connection()
+        lost_connection.cursor.return_value.execute.side_effect = vertica_python.errors.ConnectionError('lost')
+        dbsync.connection = lost_connection
+        dbsync.temp_table = 'tmp_previous_session'
+
+        new_connection = _mock_connection()
+        with patch.object(target_vertica.db_sync.DbSync, 'open_connection', return_value=new_connection):
+            dbsync.load_csv_batches([io.BytesIO(b'1\n')], 1)
+
+        # Temp tables don't survive the session, it's created again instead of truncated
+        statements = _executed_statements(new_connection)
+        assert dbsync.temp_table != 'tmp_previous_session'
+        assert statements[0].startswith('CREATE TEMPORARY TABLE IF NOT EXISTS {} '.format(dbsync.temp_table))
+        assert statements[1].startswith('INSERT INTO my_schema."my_table"')
+        new_connection.cursor.return_value.copy.assert_called_once()
+        assert dbsync.connection is new_connection
+
+    def test_reuse_temp_table(self):
+        """Test truncating the temp table of the session for the next batches"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": [],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_int": {"type": ["null", "integer"]}}}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+
+        connection = _mock_connection()
+        with patch.object(target_vertica.db_sync.DbSync, 'open_connection', return_value=connection):
+            dbsync.load_csv_batches([io.BytesIO(b'1\n')], 1)
+            temp_table = dbsync.temp_table
+            dbsync.load_csv_batches([io.BytesIO(b'2\n')], 1)
+
+        statements = [s for s in _executed_statements(connection)
+                      if s.startswith(('CREATE', 'TRUNCATE'))]
+        assert dbsync.temp_table == temp_table
+        assert len(statements) == 2
+        assert statements[0].startswith('CREATE TEMPORARY TABLE IF NOT EXISTS {} '.format(temp_table))
+        assert statements[1] == 'TRUNCATE TABLE {}'.format(temp_table)
+
+    def test_load_csv(self):
+        """Test loading a CSV file with the three argument signature"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": [],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_int": {"type": ["null", "integer"]}}}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+
+        with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+            csv_file.write(b'1\n2\n')
+            csv_file.flush()
+            with patch.object(target_vertica.db_sync.DbSync, 'load_csv_batches') as load_csv_batches_mock:
+                dbsync.load_csv(csv_file.name, 2, 4)
+
+        buffers, count = load_csv_batches_mock.call_args[0]
+        assert count == 2
+        assert [buffer.name for buffer in buffers] == [csv_file.name]
+
+    def test_copy_direct(self):
+        """Test loading batches with and without the DIRECT COPY hint and rejection table"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": [],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_int": {"type": ["null", "integer"]}}}}
+
+        # Aborting on the first invalid row by default
+        connection = _mock_connection()
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+        dbsync.connection = connection
+        dbsync.load_csv_batches([io.BytesIO(b'1\n')], 1)
+
+        copy_sql = connection.cursor.return_value.copy.call_args.args[0]
+        assert copy_sql.startswith('COPY {} FROM STDIN'.format(dbsync.temp_table))
+        assert copy_sql.endswith('ABORT ON ERROR')
+        assert 'REJECTED DATA' not in copy_sql
+        assert not [s for s in _executed_statements(connection) if 'GET_NUM_REJECTED_ROWS' in s or 'DROP' in s]
+
+        # Invalid rows are collected to a rejection table, reported and the table is dropped
+        connection = _mock_connection(fetchone={'OUTPUT': 1, 'rejected': 2})
+        dbsync = target_vertica.db_sync.DbSync({**MINIMAL_CONFIG, 'copy_direct': True}, stream_schema_message)
+        dbsync.connection = connection
+        connection.cursor.return_value.fetchall.return_value = [{'rejected_reason': 'x', 'rejected_data': 'y'}]
+        dbsync.load_csv_batches([io.BytesIO(b'1\n'), io.BytesIO(b'2\n')], 2)
+
+        rejected_table = 'my_schema.{}_rej'.format(dbsync.temp_table)
+        for call in connection.cursor.return_value.copy.call_args_list:
+            assert call.args[0].endswith('REJECTED DATA AS TABLE {} DIRECT'.format(rejected_table))
+        statements = _executed_statements(connection)
+        assert statements.count('SELECT GET_NUM_REJECTED_ROWS() AS rejected') == 2
+        assert 'SELECT rejected_reason, rejected_data FROM {} LIMIT 5'.format(rejected_table) in statements
+        assert statements.index('DROP TABLE IF EXISTS {}'.format(rejected_table)) < \
+            statements.index(dbsync.insert_from_temp_table(dbsync.temp_table))
+
+    def test_merge_from_temp_table(self):
+        """Test generating MERGE SQL to upsert the target table from the temp table"""
+        def merge_sql(key_properties, properties):
+            stream_schema_message = {
+                "stream": "public-my_table",
+                "key_properties": key_properties,
+                "schema": {
+                    "type": "object",
+                    "properties": {name: {"type": ["null", "integer"]} for name in properties}}}
+            dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+            return ' '.join(dbsync.merge_from_temp_table('tmp_table').split())
+
+        # Primary key columns are matched, not updated
+        assert merge_sql(["c_pk"], ["c_pk", "c_int"]) == \
+            'MERGE INTO my_schema."my_table" t USING tmp_table s ON s."c_pk" = t."c_pk" ' \
+            'WHEN MATCHED THEN UPDATE SET "c_int"=s."c_int" ' \
+            'WHEN NOT MATCHED THEN INSERT ("c_int", "c_pk") VALUES (s."c_int", s."c_pk")'
+
+        # Composite primary keys are matched on every key column
+        assert merge_sql(["c_pk", "c_pk2"], ["c_pk", "c_pk2", "c_int"]) == \
+            'MERGE INTO my_schema."my_table" t USING tmp_table s ON s."c_pk" = t."c_pk" AND s."c_pk2" = t."c_pk2" ' \
+            'WHEN MATCHED THEN UPDATE SET "c_int"=s."c_int" ' \
+            'WHEN NOT MATCHED THEN INSERT ("c_int", "c_pk", "c_pk2") VALUES (s."c_int", s."c_pk", s."c_pk2")'
+
+        # MERGE requires a SET list, every column is updated if every column is a primary key
+        assert merge_sql(["c_pk", "c_pk2"], ["c_pk", "c_pk2"]) == \
+            'MERGE INTO my_schema."my_table" t USING tmp_table s ON s."c_pk" = t."c_pk" AND s."c_pk2" = t."c_pk2" ' \
+            'WHEN MATCHED THEN UPDATE SET "c_pk"=s."c_pk", "c_pk2"=s."c_pk2" ' \
+            'WHEN NOT MATCHED THEN INSERT ("c_pk", "c_pk2") VALUES (s."c_pk", s."c_pk2")'
+
+    def test_load_csv_batches_with_primary_key(self):
+        """Test merging batches of streams with primary key and logging the merged rows"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": ["c_pk"],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_pk": {"type": ["null", "integer"]}}}}
+        connection = _mock_connection(fetchone={'OUTPUT': 3})
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message)
+        dbsync.connection = connection
+
+        with patch.object(dbsync, 'logger') as logger_mock:
+            dbsync.load_csv_batches([io.BytesIO(b'1\n2\n3\n')], 3)
+
+        assert _executed_statements(connection)[-1] == dbsync.merge_from_temp_table(dbsync.temp_table)
+        logger_mock.info.assert_called_with('Loading into %s: %s', 'my_schema."my_table"',
+                                            '{"inserts": 0, "updates": 0, "merges": 3, "size_bytes": 6}')
+
+    def test_update_columns(self):
+        """Test adding new columns and versioning columns with changed type in one round trip"""
+        stream_schema_message = {
+            "stream": "public-my_table",
+            "key_properties": ["c_pk"],
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "c_pk": {"type": ["null", "integer"]},
+                    "c_changed": {"type": ["null", "string"]},
+                    "c_new": {"type": ["null", "boolean"]}}}}
+        table_cache = {'my_schema': {'my_table': [('c_pk', 'int'), ('c_changed', 'int')]}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message, table_cache)
+
+        with patch.object(dbsync, 'run_statements') as run_statements_mock, \
+                patch.object(dbsync, 'query', return_value=[]) as query_mock, \
+                patch('target_vertica.db_sync.time.strftime', return_value='20200101_0000'):
+            dbsync.update_columns()
+
+        run_statements_mock.assert_called_once_with([
+            'ALTER TABLE my_schema."my_table" ADD COLUMN "c_new" boolean',
+            'ALTER TABLE my_schema."my_table" RENAME COLUMN "c_changed" TO "c_changed_20200101_0000"',
+            'ALTER TABLE my_schema."my_table" ADD COLUMN "c_changed" varchar(1024)',
+        ])
+        # Columns of the altered table are refreshed in the cache
+        query_mock.assert_called_once()
+
+        # Nothing to alter if the table matches the schema
+        table_cache = {'my_schema': {'my_table': [('c_pk', 'int'), ('c_changed', 'varchar(1024)'),
+                                                  ('c_new', 'boolean')]}}
+        dbsync = target_vertica.db_sync.DbSync(MINIMAL_CONFIG, stream_schema_message, table_cache)
+        with patch.object(dbsync, 'run_statements') as run_statements_mock:
+            dbsync.update_columns()
+        run_statements_mock.assert_not_called()
+
+    def test_connection_params_ssl(self):
+        """Test passing the ssl option to vertica-python"""
+        def ssl_param(**config):
+            return target_vertica.db_sync.DbSync({**MINIMAL_CONFIG, **config}).connection_params.get('ssl')
+
+        # SSL is disabled by default
+        assert ssl_param() is None
+
+        # Strings from config files enable SSL unless explicitly false
+        for value in ['true', 'True ', 'require', '1', 'yes']:
+            assert ssl_param(ssl=value) is True
+        for value in ['false', 'FALSE', '0', '', ' ']:
+            assert ssl_param(ssl=value) is False
+
+        # Booleans and SSLContext objects are passed through
+        ssl_context = object()
+        assert ssl_param(ssl=True) is True
+        assert ssl_param(ssl=False) is False
+        assert ssl_param(ssl=ssl_context) is ssl_context
@@ -2,8 +2,10 @@ import unittest
 import os
 import gzip
 import tempfile
+import time
 
-from unittest.mock import patch
+from datetime import datetime
+from unittest.mock import MagicMock, patch
 
 import target_vertica
 
@@ -37,3 +39,82 @@ class TestTargetVertica(unittest.TestCase):
         target_vertica.persist_lines(self.config, lines)
 
         flush_streams_mock.assert_called_once()
+
+    @patch('target_vertica.DbSync')
+    def test_persist_lines_closes_connections_on_error(self, dbsync_mock):
+        with open(f'{os.path.dirname(__file__)}/resources/logical-streams.json', 'r') as f:
+            lines = f.readlines()
+
+        instance = dbsync_mock.return_value
+        instance.sync_table.side_effect = Exception('sync failed')
+
+        with self.assertRaises(Exception):
+            target_vertica.persist_lines(self.config, lines)
+
+        instance.close.assert_called_once()
+
+    @patch('target_vertica.flush_streams')
+    @patch('target_vertica.DbSync')
+    def test_persist_lines_sets_batched_at_on_first_record_of_batch(self, dbsync_mock, flush_streams_mock):
+        self.config['batch_size_rows'] = 20
+        self.config['add_metadata_columns'] = True
+
+        with open(f'{os.path.dirname(__file__)}/resources/logical-streams.json', 'r') as f:
+            lines = f.readlines()
+
+        instance = dbsync_mock.return_value
+        instance.flatten.side_effect = dict
+        instance.record_primary_key_string.return_value = None
+
+        # Time when the first record of each batch is read, after an idle tap
+        first_arrivals = []
+        record_count = 0
+
+        def slow_tap_lines():
+            nonlocal record_count
+            for line in lines:
+                if '"RECORD"' in line:
+                    if record_count % 20 == 0:
+                        time.sleep(0.01)
+                        first_arrivals.append(datetime.now().isoformat())
+                    record_count += 1
+                yield line
+
+        batches = []
+
+        def flush_streams(streams, row_count, *args, **kwargs):
+            for stream, records in streams.items():
+                if row_count[stream] > 0:
+                    batches.append([record['_sdc_batched_at'] for record in records.values()])
+                    row_count[stream] = 0
+                streams[stream] = {}
+            return None
+
+        flush_streams_mock.side_effect = flush_streams
+
+        target_vertica.persist_lines(self.config, slow_tap_lines())
+
+        assert [len(batch) for batch in batches] == [20, 20]
+        for batch, first_arrival in zip(batches, first_arrivals):
+            # Records of one batch share the value and it's not earlier than the first record
+            assert len(set(batch)) == 1
+            assert batch[0] >= first_arrival
+
+    def test_close_idle_sessions(self):
+        stream_to_sync = {stream: MagicMock() for stream in ['a', 'b', 'c']}
+        flushed_streams = {}
+
+        target_vertica.close_idle_sessions(stream_to_sync, flushed_streams, ['a', 'b'], 2)
+        target_vertica.close_idle_sessions(stream_to_sync, flushed_streams, ['a'], 2)
+
+        # Sessions of the flushed streams are kept open for the next batch
+        for db_sync in stream_to_sync.values():
+            db_sync.close.assert_not_called()
+
+        target_vertica.close_idle_sessions(stream_to_sync, flushed_streams, ['c'], 2)
+
+        # Only the session of the least recently flushed stream is closed
+        stream_to_sync['b'].close.assert_called_once()
+        stream_to_sync['a'].close.assert_not_called()
+        stream_to_sync['c'].close.assert_not_called()
+        assert list(flushed_streams) == ['a', 'c']